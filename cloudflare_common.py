@@ -0,0 +1,90 @@
+"""
+Utilidades compartidas por main.py y test_credentials.py.
+"""
+import json
+import os
+
+# orjson es opcional: si está instalado se usa para leer y escribir JSON más rápido
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj, indent=2).encode()
+
+CLOUDFLARE_API = "https://api.cloudflare.com/client/v4"
+CF_TIMEOUT = 30  # segundos por petición a la API de Cloudflare
+
+# Caché de test_credentials.py con las credenciales verificadas recientemente
+CREDENTIALS_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "cloudflare-dns-local-ip", "credentials.json")
+
+
+class CloudflareAPIError(Exception):
+    """Respuesta de error de la API de Cloudflare (HTTP no 2xx o success=false)."""
+
+    def __init__(self, status_code, message):
+        super().__init__(f"Error HTTP {status_code} de la API de Cloudflare: {message}")
+        self.status_code = status_code
+
+
+def find_zone_id(session, record_name, timeout=CF_TIMEOUT):
+    """
+    Busca en Cloudflare el ID de la zona que contiene record_name.
+    Se prueban los sufijos del nombre de menor a mayor (ejemplo.com, sub.ejemplo.com, ...)
+    para soportar dominios como ejemplo.co.uk.
+    Devuelve None si ninguna zona coincide y lanza CloudflareAPIError si la API responde con error.
+    """
+    labels = record_name.rstrip('.').split('.')
+    for i in range(len(labels) - 2, -1, -1):
+        zone_name = '.'.join(labels[i:])
+        response = session.get(f"{CLOUDFLARE_API}/zones", params={'name': zone_name}, timeout=timeout)
+        if not response.ok:
+            raise CloudflareAPIError(response.status_code, response.text[:200])
+        
+        data = json_loads(response.content)
+        if not data['success']:
+            error_messages = ', '.join([error['message'] for error in data['errors']])
+            raise CloudflareAPIError(response.status_code, error_messages)
+        
+        if data['result']:
+            return data['result'][0]['id']
+    
+    return None
+
+
+def write_atomic(path, data, mode=0o600):
+    """
+    Escribe data (bytes) en path a través de un archivo temporal que luego lo
+    reemplaza, para que una interrupción no lo deje a medias. El archivo solo
+    es legible por el usuario actual.
+    """
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def invalidate_credentials_cache():
+    """
+    Borra la caché de test_credentials.py. Se llama cuando Cloudflare rechaza las
+    credenciales (HTTP 401/403), para que la siguiente prueba consulte la API.
+    """
+    try:
+        os.remove(CREDENTIALS_CACHE_FILE)
+    except OSError:
+        pass
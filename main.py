@@ -2,56 +2,219 @@
 import requests
 import os
 import sys
-import json
 import logging
+import ipaddress
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Configurar logging
+from cloudflare_common import (
+    json_loads, json_dumps, write_atomic, invalidate_credentials_cache,
+    CLOUDFLARE_API, CF_TIMEOUT, CloudflareAPIError, find_zone_id,
+)
+
+# Cargar variables de entorno desde el archivo .env
+load_dotenv()
+
+# Configurar logging. Con LOG_FILE la consola solo se usa si es una terminal,
+# para que cron no reenvíe por correo cada línea que ya queda en el archivo.
+log_handlers = []
+log_file = os.getenv("LOG_FILE")
+if not log_file or sys.stderr.isatty():
+    log_handlers.append(logging.StreamHandler())
+if log_file:
+    # Solo se importa si se usa: logging.handlers arrastra varios módulos más
+    from logging.handlers import TimedRotatingFileHandler
+    
+    # Un archivo por día, rotado a medianoche; se conservan los últimos LOG_BACKUP_COUNT
+    log_handlers.append(TimedRotatingFileHandler(
+        log_file,
+        when='midnight',
+        backupCount=int(os.getenv("LOG_BACKUP_COUNT", "90")),
+        encoding='utf-8'
+    ))
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
+    handlers=log_handlers
 )
 logger = logging.getLogger(__name__)
 
-# Cargar variables de entorno desde el archivo .env
-load_dotenv()
+def _new_session(max_retries):
+    """
+    Crea una sesión HTTP que reutiliza las conexiones TCP/TLS entre llamadas.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Sesión para los servicios de IP pública. Sin reintentos: se consultan todos
+# a la vez, así que basta con que responda cualquiera de ellos.
+SESSION = _new_session(max_retries=0)
+
+# Sesión para la API de Cloudflare: lleva las credenciales, que así nunca
+# se envían a los servicios de IP. Los reintentos esperan 0.5s, 1s, 2s... (máximo 4s)
+# con una variación aleatoria para no coincidir con otros clientes que reintentan a la vez.
+CF_SESSION = _new_session(max_retries=Retry(
+    total=3,
+    backoff_factor=0.5,
+    backoff_max=4,
+    backoff_jitter=0.25,
+    status_forcelist=[429, 500, 502, 503, 504],
+    # Al agotar los reintentos se devuelve la última respuesta en lugar de lanzar
+    # RetryError, para que los errores HTTP se registren con su código
+    raise_on_status=False
+))
+CF_SESSION.headers.update({
+    'Content-Type': 'application/json',
+    'User-Agent': 'cloudflare-dns-local-ip',
+})
+
+# Tiempo máximo (segundos) para obtener la IP pública, sumando todos los servicios
+IP_LOOKUP_TIMEOUT = 12
+
+# Archivo donde se guarda el estado entre ejecuciones (zone_id resueltos, etc.)
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dns_cache.json")
+
+# Intervalo máximo sin comprobar el registro en Cloudflare cuando la IP no cambia
+VERIFY_INTERVAL = timedelta(hours=24)
+
+# Campos de cada registro DNS que se guardan junto a su ETag
+CACHED_RECORD_FIELDS = ('id', 'name', 'type', 'content', 'ttl', 'proxied', 'comment', 'tags')
+
+# Contenido del archivo de caché tal como se leyó o escribió por última vez
+_cache_bytes = None
+
+def load_cache():
+    """
+    Carga el estado guardado de ejecuciones anteriores.
+    Si el archivo no existe o está dañado se empieza con un estado vacío.
+    """
+    global _cache_bytes
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            data = f.read()
+        cache = json_loads(data)
+        _cache_bytes = data
+        return cache
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"No se pudo leer la caché {CACHE_FILE}: {e}")
+        return {}
+
+def save_cache(cache):
+    """
+    Guarda el estado para la siguiente ejecución.
+    Se escribe en un archivo temporal que luego reemplaza al original, para que una
+    interrupción no deje la caché a medias, y no se escribe nada si no hubo cambios.
+    """
+    global _cache_bytes
+    data = json_dumps(cache)
+    if data == _cache_bytes:
+        return
+    
+    try:
+        write_atomic(CACHE_FILE, data)
+        _cache_bytes = data
+    except OSError as e:
+        logger.warning(f"No se pudo guardar la caché {CACHE_FILE}: {e}")
+
+def log_api_error(response, action):
+    """
+    Registra una respuesta de error de la API de Cloudflare. Si las credenciales
+    fueron rechazadas (401/403) se borra la caché de test_credentials.py.
+    """
+    if response.status_code in (401, 403):
+        invalidate_credentials_cache()
+    logger.error(f"Error HTTP {response.status_code} de la API de Cloudflare al {action}: {response.text[:200]}")
+
+def validate_ip(ip):
+    """
+    Comprueba que la cadena recibida sea una dirección IPv4 válida.
+    """
+    try:
+        ipaddress.IPv4Address(ip)
+        return True
+    except ValueError:
+        return False
+
+def fetch_ip(url, headers=None):
+    """
+    Consulta un servicio externo y devuelve la IP que reporta.
+    """
+    logger.debug(f"Intentando obtener IP desde {url}")
+    response = SESSION.get(url, headers=headers, timeout=5)
+    response.raise_for_status()
+    
+    if "ipify" in url:
+        return json_loads(response.content)["ip"]
+    return response.text.strip()
 
 def get_current_ip():
     """
     Obtiene la dirección IP pública actual utilizando un servicio externo.
-    Se prueban múltiples servicios para mayor robustez.
+    Se consultan todos los servicios en paralelo y se usa la primera respuesta válida.
     """
     ip_services = [
         "https://api.ipify.org?format=json",
         "https://icanhazip.com/",
         "https://ident.me/",
         "http://checkip.amazonaws.com/",
+        "https://ifconfig.io/",
     ]
+    # ifconfig.io solo responde en texto plano a clientes tipo curl
+    service_headers = {
+        "https://ifconfig.io/": {'User-Agent': 'curl/8.0'},
+    }
+    
+    # Cada servicio se consulta en un hilo daemon: los que no hayan respondido
+    # cuando se obtenga la IP (o venza el plazo) no retrasan la salida del proceso
+    results = queue.Queue()
+    
+    def worker(url):
+        try:
+            results.put((url, fetch_ip(url, service_headers.get(url)), None))
+        except Exception as e:
+            results.put((url, None, e))
     
     for url in ip_services:
+        threading.Thread(target=worker, args=(url,), daemon=True).start()
+    
+    deadline = time.monotonic() + IP_LOOKUP_TIMEOUT
+    for _ in ip_services:
+        remaining = deadline - time.monotonic()
         try:
-            logger.debug(f"Intentando obtener IP desde {url}")
-            response = requests.get(url, timeout=5)
-            response.raise_for_status()
-            
-            if "ipify" in url:
-                ip = response.json()["ip"]
-            else:
-                ip = response.text.strip()
-                
-            logger.debug(f"IP obtenida: {ip}")
-            return ip
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Error al obtener la IP de {url}: {e}")
+            url, ip, error = results.get(timeout=max(remaining, 0))
+        except queue.Empty:
+            logger.warning(f"Ningún servicio respondió en {IP_LOOKUP_TIMEOUT} segundos")
+            break
+        
+        if error is not None:
+            logger.warning(f"Error al obtener la IP de {url}: {error}")
             continue
+        
+        if not validate_ip(ip):
+            logger.warning(f"Respuesta no válida de {url}: {ip!r}")
+            continue
+        
+        logger.debug(f"IP obtenida desde {url}: {ip}")
+        return ip
     
     logger.error("No se pudo obtener la IP pública actual desde ningún servicio.")
     sys.exit(1)
 
 def get_cloudflare_config():
     """
-    Obtiene la configuración de Cloudflare desde las variables de entorno.
+    Obtiene la configuración de Cloudflare desde las variables de entorno
+    y configura las credenciales en la sesión de Cloudflare.
     """
     try:
         # Obtener credenciales y configuración
@@ -63,44 +226,68 @@ def get_cloudflare_config():
         # Validar que existan las variables necesarias
         if not api_key:
             raise ValueError("CF_API_KEY no está configurada")
-        if not zone_id:
-            raise ValueError("CF_ZONE_ID no está configurada")
         if not dns_record_name:
             raise ValueError("CF_DNS_RECORD_NAME no está configurada")
         
-        # Configurar los headers para la API de Cloudflare
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        
         # Si tenemos email, usamos Global API Key
         if api_email:
             logger.info("Usando Global API Key con email")
-            headers['X-Auth-Email'] = api_email
-            headers['X-Auth-Key'] = api_key
+            CF_SESSION.headers['X-Auth-Email'] = api_email
+            CF_SESSION.headers['X-Auth-Key'] = api_key
         else:
             # Si no hay email, usamos API Token
             logger.info("Usando API Token")
-            headers['Authorization'] = f'Bearer {api_key}'
+            CF_SESSION.headers['Authorization'] = f'Bearer {api_key}'
         
-        return headers, zone_id, dns_record_name
+        return zone_id, dns_record_name
     
     except ValueError as e:
         logger.error(f"Error de configuración: {e}")
-        logger.error("Asegúrate de configurar CF_API_KEY, CF_ZONE_ID y CF_DNS_RECORD_NAME en el archivo .env")
+        logger.error("Asegúrate de configurar CF_API_KEY y CF_DNS_RECORD_NAME en el archivo .env")
         logger.error("Si usas una Global API Key, también configura CF_EMAIL")
         sys.exit(1)
     except Exception as e:
         logger.error(f"Error al obtener la configuración de Cloudflare: {e}")
         sys.exit(1)
 
-def list_dns_records(headers, zone_id, record_name=None, record_type='A'):
+def get_zone_id(record_name):
+    """
+    Busca en Cloudflare el ID de la zona que contiene record_name.
+    Termina el script si la API falla o si no se encuentra ninguna zona.
+    """
+    logger.info(f"Buscando la zona de '{record_name}' en Cloudflare")
+    try:
+        zone_id = find_zone_id(CF_SESSION, record_name)
+    except CloudflareAPIError as e:
+        if e.status_code in (401, 403):
+            invalidate_credentials_cache()
+        logger.error(f"{e} al buscar la zona")
+        sys.exit(1)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error de conexión con la API de Cloudflare al buscar la zona: {e}")
+        sys.exit(1)
+    except Exception as e:
+        logger.error(f"Error inesperado al buscar la zona: {e}")
+        sys.exit(1)
+    
+    if zone_id is None:
+        logger.error(f"No se encontró ninguna zona de Cloudflare para '{record_name}'")
+        logger.error("Configura CF_ZONE_ID en el archivo .env o revisa CF_DNS_RECORD_NAME")
+        sys.exit(1)
+    
+    logger.info(f"Zona encontrada con ID: {zone_id}")
+    return zone_id
+
+def list_dns_records(zone_id, record_name=None, record_type='A', cached=None):
     """
     Lista todos los registros DNS de la zona especificada.
     Si se proporciona record_name, filtra por ese nombre.
+    Si se proporciona cached ({'etag': ..., 'records': [...]}) se hace una petición
+    condicional y, si Cloudflare responde 304, se devuelven los registros guardados.
+    Devuelve una tupla (registros, etag); registros es None si la zona no existe.
     """
     try:
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
+        url = f"{CLOUDFLARE_API}/zones/{zone_id}/dns_records"
         params = {}
         
         if record_name:
@@ -110,38 +297,45 @@ def list_dns_records(headers, zone_id, record_name=None, record_type='A'):
             
         logger.info(f"Listando registros DNS{' para ' + record_name if record_name else ''} (tipo {record_type})")
         
-        response = requests.get(url, headers=headers, params=params)
-        response.raise_for_status()
+        request_headers = None
+        if cached and cached.get('etag'):
+            request_headers = {'If-None-Match': cached['etag']}
+        
+        response = CF_SESSION.get(url, headers=request_headers, params=params, timeout=CF_TIMEOUT)
+        if response.status_code == 304:
+            logger.info("Los registros DNS no han cambiado desde la última consulta")
+            return cached['records'], cached['etag']
+        if response.status_code == 404:
+            logger.warning(f"La zona '{zone_id}' no existe o no es accesible")
+            return None, None
+        if not response.ok:
+            log_api_error(response, "listar registros DNS")
+            sys.exit(1)
         
-        data = response.json()
+        data = json_loads(response.content)
         
         if not data['success']:
             error_messages = ', '.join([error['message'] for error in data['errors']])
             raise Exception(f"Error de la API de Cloudflare: {error_messages}")
         
         records = data['result']
+        etag = response.headers.get('ETag')
         
         if not records:
             logger.warning(f"No se encontraron registros DNS{' para ' + record_name if record_name else ''}")
-            return []
+            return [], etag
         
         logger.info(f"Se encontraron {len(records)} registros DNS")
-        return records
+        return records, etag
     
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error de la API de Cloudflare al listar registros DNS: {e}")
-        # Mostrar el contenido de la respuesta si está disponible
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                logger.error(f"Detalles de la respuesta: {e.response.json()}")
-            except:
-                logger.error(f"Código de respuesta: {e.response.status_code}")
+        logger.error(f"Error de conexión con la API de Cloudflare al listar registros DNS: {e}")
         sys.exit(1)
     except Exception as e:
         logger.error(f"Error inesperado al listar registros DNS: {e}")
         sys.exit(1)
 
-def update_dns_record(headers, zone_id, record_id, record_name, new_ip, existing_record):
+def update_dns_record(zone_id, record_id, record_name, new_ip, existing_record):
     """
     Actualiza un registro DNS con la nueva dirección IP.
     """
@@ -154,16 +348,22 @@ def update_dns_record(headers, zone_id, record_id, record_name, new_ip, existing
             'ttl': existing_record.get('ttl', 300),
             'proxied': existing_record.get('proxied', False)
         }
+        # PUT reemplaza el registro completo: conservar también comentario y etiquetas
+        for key in ('comment', 'tags'):
+            if existing_record.get(key):
+                dns_record[key] = existing_record[key]
         
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records/{record_id}"
+        url = f"{CLOUDFLARE_API}/zones/{zone_id}/dns_records/{record_id}"
         
         logger.info(f"Actualizando registro DNS {record_name} a {new_ip}")
         logger.debug(f"Configuración del registro: {dns_record}")
         
-        response = requests.put(url, headers=headers, json=dns_record)
-        response.raise_for_status()
+        response = CF_SESSION.put(url, json=dns_record, timeout=CF_TIMEOUT)
+        if not response.ok:
+            log_api_error(response, "actualizar el registro DNS")
+            return False
         
-        data = response.json()
+        data = json_loads(response.content)
         
         if not data['success']:
             error_messages = ', '.join([error['message'] for error in data['errors']])
@@ -173,13 +373,41 @@ def update_dns_record(headers, zone_id, record_id, record_name, new_ip, existing
         return True
     
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error de la API de Cloudflare al actualizar el registro DNS: {e}")
-        # Mostrar el contenido de la respuesta si está disponible
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                logger.error(f"Detalles de la respuesta: {e.response.json()}")
-            except:
-                logger.error(f"Código de respuesta: {e.response.status_code}")
+        logger.error(f"Error de conexión con la API de Cloudflare al actualizar el registro DNS: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Error inesperado al actualizar el registro DNS: {e}")
+        return False
+
+def patch_dns_record(zone_id, record_id, record_name, new_ip):
+    """
+    Cambia solo la IP de un registro DNS ya conocido mediante PATCH.
+    El resto de la configuración del registro (TTL, proxy...) no se modifica.
+    """
+    try:
+        url = f"{CLOUDFLARE_API}/zones/{zone_id}/dns_records/{record_id}"
+        
+        logger.info(f"Actualizando registro DNS {record_name} ({record_id}) a {new_ip}")
+        
+        response = CF_SESSION.patch(url, json={'content': new_ip}, timeout=CF_TIMEOUT)
+        if response.status_code == 404:
+            logger.warning(f"El registro DNS '{record_id}' ya no existe")
+            return False
+        if not response.ok:
+            log_api_error(response, "actualizar el registro DNS")
+            return False
+        
+        data = json_loads(response.content)
+        
+        if not data['success']:
+            error_messages = ', '.join([error['message'] for error in data['errors']])
+            raise Exception(f"Error de la API de Cloudflare: {error_messages}")
+        
+        logger.info(f"Registro DNS '{record_name}' actualizado exitosamente a la IP: {new_ip}")
+        return True
+    
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error de conexión con la API de Cloudflare al actualizar el registro DNS: {e}")
         return False
     except Exception as e:
         logger.error(f"Error inesperado al actualizar el registro DNS: {e}")
@@ -189,27 +417,83 @@ def main():
     logger.info("Iniciando el script de actualización de DNS de Cloudflare...")
     
     # 1. Obtener configuración de Cloudflare
-    headers, zone_id, dns_record_name = get_cloudflare_config()
+    zone_id, dns_record_name = get_cloudflare_config()
+    cache = load_cache()
+    zone_ids = cache.setdefault('zone_ids', {})
     
-    # 2. Obtener la IP pública actual
-    current_ip = get_current_ip()
-    logger.info(f"IP pública actual detectada: {current_ip}")
+    # Sin CF_ZONE_ID, usar el zone_id resuelto en ejecuciones anteriores
+    zone_from_cache = False
+    if not zone_id:
+        zone_id = zone_ids.get(dns_record_name)
+        zone_from_cache = zone_id is not None
+        if not zone_id:
+            zone_id = get_zone_id(dns_record_name)
+            zone_ids[dns_record_name] = zone_id
+            save_cache(cache)
     
-    # 3. Listar todos los registros DNS para depuración
-    logger.info("Listando todos los registros DNS de la zona para depuración")
-    all_records = list_dns_records(headers, zone_id)
+    # 2. Obtener la IP pública actual
+    record_state = cache.setdefault('records', {}).get(dns_record_name, {})
+    last_verified = record_state.get('last_verified')
+    try:
+        recently_verified = bool(last_verified) and datetime.now() - datetime.fromisoformat(last_verified) < VERIFY_INTERVAL
+    except (TypeError, ValueError):
+        logger.warning(f"Fecha de verificación no válida en la caché: {last_verified!r}")
+        recently_verified = False
     
-    if not all_records:
-        logger.error(f"No se encontraron registros DNS en la zona '{zone_id}'")
-        sys.exit(1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Si el registro hay que consultarlo de todos modos, se lista mientras se obtiene la IP
+        records_future = None
+        if not recently_verified:
+            records_future = executor.submit(
+                list_dns_records, zone_id, record_name=dns_record_name, cached=record_state
+            )
+        
+        current_ip = get_current_ip()
+        logger.info(f"IP pública actual detectada: {current_ip}")
+        
+        # Si la IP coincide con la última verificada recientemente, no consultar Cloudflare
+        if recently_verified and current_ip == record_state.get('ip'):
+            logger.info(f"La IP actual ({current_ip}) coincide con la última verificada el {last_verified}. No se requiere actualización.")
+            logger.info("Proceso finalizado.")
+            return
+        
+        # Si la IP cambió pero los registros se verificaron recientemente, ya se conocen
+        # sus IDs: basta con un PATCH por registro, sin volver a listarlos
+        record_ids = record_state.get('record_ids')
+        if recently_verified and record_ids:
+            logger.info(f"La IP ha cambiado de {record_state.get('ip')} a {current_ip}. Actualizando los registros conocidos...")
+            if all(patch_dns_record(zone_id, record_id, dns_record_name, current_ip) for record_id in record_ids):
+                cache['records'][dns_record_name] = {
+                    'ip': current_ip,
+                    'last_verified': datetime.now().isoformat(timespec='seconds'),
+                    'record_ids': record_ids,
+                }
+                save_cache(cache)
+                logger.info("Se actualizaron uno o más registros DNS exitosamente.")
+                logger.info("Proceso finalizado.")
+                return
+            logger.info("No se pudieron actualizar los registros conocidos, se consultan de nuevo en Cloudflare")
+        
+        # 3. Obtener los registros DNS (Cloudflare filtra por nombre y tipo)
+        if records_future is None:
+            dns_records, etag = list_dns_records(zone_id, record_name=dns_record_name, cached=record_state)
+        else:
+            dns_records, etag = records_future.result()
     
-    # Mostrar todos los registros para depuración
-    for record in all_records:
-        logger.info(f"Registro encontrado: {record['name']} (tipo {record['type']}) con contenido: {record['content']}")
+    # Si la zona guardada ya no existe, volver a resolverla una vez
+    if dns_records is None and zone_from_cache:
+        logger.info("El zone_id guardado no es válido, se vuelve a buscar la zona")
+        zone_id = get_zone_id(dns_record_name)
+        zone_ids[dns_record_name] = zone_id
+        save_cache(cache)
+        dns_records, etag = list_dns_records(zone_id, record_name=dns_record_name)
     
-    # 4. Buscar registros DNS específicos
-    dns_records = [r for r in all_records if r['name'] == dns_record_name and r['type'] == 'A']
+    # Mostrar los registros para depuración
+    if dns_records and logger.isEnabledFor(logging.DEBUG):
+        for record in dns_records:
+            logger.debug(f"Registro encontrado: {record['name']} (tipo {record['type']}) con contenido: {record['content']}")
     
+    # 4. Comprobar que exista el registro DNS
     if not dns_records:
         logger.error(f"No se encontró el registro DNS '{dns_record_name}' de tipo 'A' en la zona '{zone_id}'")
         logger.error("Por favor, asegúrate de que el registro exista en Cloudflare y que CF_DNS_RECORD_NAME sea correcto")
@@ -217,6 +501,7 @@ def main():
     
     # 5. Procesar cada registro encontrado
     updated = False
+    failed = False
     for record in dns_records:
         record_id = record['id']
         existing_ip = record['content']
@@ -229,15 +514,34 @@ def main():
             logger.info(f"La IP actual ({current_ip}) coincide con la del registro DNS. No se requiere actualización.")
         else:
             logger.info(f"La IP ha cambiado. Actualizando el registro DNS de {existing_ip} a {current_ip}...")
-            success = update_dns_record(headers, zone_id, record_id, record_name, current_ip, record)
+            success = update_dns_record(zone_id, record_id, record_name, current_ip, record)
             if success:
                 updated = True
+            else:
+                failed = True
     
     if updated:
         logger.info("Se actualizaron uno o más registros DNS exitosamente.")
     else:
         logger.info("No se requirió actualización de registros DNS.")
     
+    # Recordar la IP verificada para omitir la consulta en las próximas ejecuciones.
+    # El ETag y los registros solo siguen siendo válidos si no se modificó nada.
+    if not failed:
+        record_state = {
+            'ip': current_ip,
+            'last_verified': datetime.now().isoformat(timespec='seconds'),
+            'record_ids': [record['id'] for record in dns_records],
+        }
+        if etag and not updated:
+            record_state['etag'] = etag
+            record_state['records'] = [
+                {key: record[key] for key in CACHED_RECORD_FIELDS if key in record}
+                for record in dns_records
+            ]
+        cache['records'][dns_record_name] = record_state
+        save_cache(cache)
+    
     logger.info("Proceso finalizado.")
 
 if __name__ == "__main__":
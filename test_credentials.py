@@ -2,78 +2,198 @@
 import requests
 import os
 import sys
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from cloudflare_common import (
+    json_loads, json_dumps, write_atomic, invalidate_credentials_cache,
+    CLOUDFLARE_API, CF_TIMEOUT, CREDENTIALS_CACHE_FILE, CloudflareAPIError, find_zone_id,
+)
 
 # Cargar variables de entorno desde el archivo .env
 load_dotenv()
 
-def test_cloudflare_credentials():
+# Sesión HTTP compartida: reutiliza las conexiones TCP/TLS con la API de Cloudflare
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.headers.update({'Content-Type': 'application/json'})
+
+# Caché de verificaciones correctas, para no repetir las consultas al volver a ejecutar el script
+# (main.py la borra si Cloudflare rechaza las credenciales)
+CACHE_FILE = CREDENTIALS_CACHE_FILE
+CACHE_TTL = 600  # segundos
+
+def _cache_get(key):
+    """
+    Devuelve el resultado guardado para key si existe y no ha caducado.
+    """
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            entry = json_loads(f.read()).get(key)
+    except (OSError, ValueError):
+        return None
+    
+    if entry and time.time() < entry.get('expires_at', 0):
+        return entry
+    return None
+
+def _cache_put(key, value, ttl=CACHE_TTL):
+    """
+    Guarda value para key durante ttl segundos. El archivo solo es legible por el usuario actual.
+    """
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        cache = {}
+    
+    now = time.time()
+    cache = {k: v for k, v in cache.items() if v.get('expires_at', 0) > now}
+    cache[key] = dict(value, expires_at=now + ttl)
+    
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), mode=0o700, exist_ok=True)
+        write_atomic(CACHE_FILE, json_dumps(cache))
+    except OSError:
+        pass
+
+def test_cloudflare_credentials(use_cache=True, verbose=False):
     """
     Prueba las credenciales de Cloudflare para verificar si son válidas.
+    Si las mismas credenciales se verificaron con éxito hace menos de CACHE_TTL
+    segundos se muestra ese resultado sin consultar la API (use_cache=False lo evita).
+    Con verbose=True se muestran también los pasos intermedios y las respuestas completas.
     """
+    def debug(msg):
+        if verbose:
+            print(msg)
+    
     # Obtener credenciales y configuración
     api_key = os.getenv("CF_API_KEY")
     api_email = os.getenv("CF_EMAIL")
     zone_id = os.getenv("CF_ZONE_ID")
+    dns_record_name = os.getenv("CF_DNS_RECORD_NAME")
     
-    print(f"Probando credenciales de Cloudflare:")
-    print(f"- Email: {api_email}")
-    print(f"- API Key: {api_key[:5]}...{api_key[-5:]} (oculto por seguridad)")
-    print(f"- Zone ID: {zone_id}")
-    
-    # Configurar los headers para la API de Cloudflare
-    headers = {
-        'Content-Type': 'application/json',
-    }
+    # Cada bloque de salida se escribe de una vez en lugar de línea a línea
+    print("\n".join([
+        "Probando credenciales de Cloudflare:",
+        f"- Email: {api_email}",
+        f"- API Key: {api_key[:5]}...{api_key[-5:]} (oculto por seguridad)",
+        f"- Zone ID: {zone_id}",
+    ]))
     
+    # Configurar las credenciales en la sesión de la API de Cloudflare
     # Si tenemos email, usamos Global API Key
     if api_email:
         print("\nUsando Global API Key con email")
-        headers['X-Auth-Email'] = api_email
-        headers['X-Auth-Key'] = api_key
+        SESSION.headers['X-Auth-Email'] = api_email
+        SESSION.headers['X-Auth-Key'] = api_key
     else:
         # Si no hay email, usamos API Token
         print("\nUsando API Token")
-        headers['Authorization'] = f'Bearer {api_key}'
+        SESSION.headers['Authorization'] = f'Bearer {api_key}'
     
-    # Probar la autenticación obteniendo información de la zona
+    if not zone_id and not dns_record_name:
+        print("\n❌ Configura CF_ZONE_ID o CF_DNS_RECORD_NAME en el archivo .env")
+        return False
+    
+    # La clave no contiene las credenciales, solo un resumen de ellas. Sin CF_ZONE_ID se usa
+    # el nombre del registro DNS, y la zona encontrada se guarda junto al resultado.
+    cache_key = hashlib.sha256(f"{api_email}:{api_key}:{zone_id or dns_record_name}".encode()).hexdigest()[:16]
+    cached = _cache_get(cache_key) if use_cache else None
+    if cached:
+        print("\n".join([
+            f"\n✅ Credenciales verificadas hace menos de {CACHE_TTL // 60} minutos (usa --no-cache para repetir la prueba)",
+            f"   Zona: {cached['zone_name']}, {cached['record_count']} registros DNS",
+        ] + ([
+            "   Añade esta línea al archivo .env para que main.py no tenga que buscar la zona:",
+            f'   CF_ZONE_ID="{cached["zone_id"]}"',
+        ] if not zone_id else []) + [
+            "\nPrimeros registros encontrados:",
+        ] + [
+            f"  {i+1}. {name} ({record_type}): {content}"
+            for i, (name, record_type, content) in enumerate(cached['records'])
+        ]))
+        return True
+    
+    # Sin CF_ZONE_ID, buscar la zona a partir del registro DNS y sugerir guardarla
+    if not zone_id:
+        print(f"\nCF_ZONE_ID no está configurada, buscando la zona de {dns_record_name}...")
+        try:
+            zone_id = find_zone_id(SESSION, dns_record_name, timeout=CF_TIMEOUT)
+        except CloudflareAPIError as e:
+            if e.status_code in (401, 403):
+                invalidate_credentials_cache()
+            print(f"❌ Error al buscar la zona: {e}")
+            return False
+        except Exception as e:
+            print(f"❌ Error al buscar la zona: {e}")
+            return False
+        if not zone_id:
+            print(f"❌ No se encontró ninguna zona de Cloudflare para '{dns_record_name}'")
+            return False
+        
+        print("✅ Zona encontrada. Añade esta línea al archivo .env para que main.py no tenga que buscarla:")
+        print(f'   CF_ZONE_ID="{zone_id}"')
+    
+    # Probar la autenticación obteniendo información de la zona. Los registros DNS
+    # se consultan a la vez, ya que ambas peticiones son independientes.
     try:
-        print(f"\nProbando acceso a la zona {zone_id}...")
-        url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}"
-        response = requests.get(url, headers=headers)
+        debug(f"\nProbando acceso a la zona {zone_id}...")
+        url = f"{CLOUDFLARE_API}/zones/{zone_id}"
+        dns_url = f"{CLOUDFLARE_API}/zones/{zone_id}/dns_records"
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            zone_future = executor.submit(SESSION.get, url, timeout=CF_TIMEOUT)
+            # Solo se muestran 5 registros: el total se lee de result_info
+            dns_future = executor.submit(SESSION.get, dns_url, params={'per_page': 5}, timeout=CF_TIMEOUT)
+            response = zone_future.result()
+            dns_response = dns_future.result()
+        
+        # Credenciales rechazadas: descartar los resultados guardados
+        if response.status_code in (401, 403) or dns_response.status_code in (401, 403):
+            invalidate_credentials_cache()
         
         if response.status_code == 200:
-            data = response.json()
+            data = json_loads(response.content)
             if data['success']:
                 zone_name = data['result']['name']
                 print(f"✅ Autenticación exitosa! Zona encontrada: {zone_name}")
                 
                 # Probar acceso a los registros DNS
-                print(f"\nProbando acceso a los registros DNS de la zona...")
-                dns_url = f"https://api.cloudflare.com/client/v4/zones/{zone_id}/dns_records"
-                dns_response = requests.get(dns_url, headers=headers)
+                debug("\nProbando acceso a los registros DNS de la zona...")
                 
                 if dns_response.status_code == 200:
-                    dns_data = dns_response.json()
+                    dns_data = json_loads(dns_response.content)
                     if dns_data['success']:
-                        record_count = len(dns_data['result'])
+                        record_count = dns_data.get('result_info', {}).get('total_count', len(dns_data['result']))
                         print(f"✅ Acceso a registros DNS exitoso! Se encontraron {record_count} registros.")
                         
-                        # Mostrar los primeros 5 registros
-                        print("\nPrimeros registros encontrados:")
-                        for i, record in enumerate(dns_data['result'][:5]):
-                            print(f"  {i+1}. {record['name']} ({record['type']}): {record['content']}")
+                        # Mostrar los primeros 5 registros (los únicos que se pidieron)
+                        print("\n".join(["\nPrimeros registros encontrados:"] + [
+                            f"  {i+1}. {record['name']} ({record['type']}): {record['content']}"
+                            for i, record in enumerate(dns_data['result'])
+                        ]))
                         
+                        _cache_put(cache_key, {
+                            'zone_id': zone_id,
+                            'zone_name': zone_name,
+                            'record_count': record_count,
+                            'records': [[r['name'], r['type'], r['content']] for r in dns_data['result']],
+                        })
                         return True
                     else:
                         error_messages = ', '.join([error['message'] for error in dns_data['errors']])
                         print(f"❌ Error al acceder a los registros DNS: {error_messages}")
                 else:
-                    print(f"❌ Error HTTP {dns_response.status_code} al acceder a los registros DNS: {dns_response.text}")
+                    print(f"❌ Error HTTP {dns_response.status_code} al acceder a los registros DNS")
+                    debug(f"   Respuesta: {dns_response.text}")
                     
                     # Intentar parsear la respuesta JSON si es posible
                     try:
-                        error_data = dns_response.json()
+                        error_data = json_loads(dns_response.content)
                         if 'errors' in error_data:
                             for error in error_data['errors']:
                                 print(f"   - Código: {error.get('code')}, Mensaje: {error.get('message')}")
@@ -83,11 +203,12 @@ def test_cloudflare_credentials():
                 error_messages = ', '.join([error['message'] for error in data['errors']])
                 print(f"❌ Error de la API de Cloudflare: {error_messages}")
         else:
-            print(f"❌ Error HTTP {response.status_code}: {response.text}")
+            print(f"❌ Error HTTP {response.status_code} al acceder a la zona")
+            debug(f"   Respuesta: {response.text}")
             
             # Intentar parsear la respuesta JSON si es posible
             try:
-                error_data = response.json()
+                error_data = json_loads(response.content)
                 if 'errors' in error_data:
                     for error in error_data['errors']:
                         print(f"   - Código: {error.get('code')}, Mensaje: {error.get('message')}")
@@ -100,4 +221,7 @@ def test_cloudflare_credentials():
     return False
 
 if __name__ == "__main__":
-    test_cloudflare_credentials()
+    test_cloudflare_credentials(
+        use_cache="--no-cache" not in sys.argv[1:],
+        verbose="--verbose" in sys.argv[1:]
+    )